@@ -237,6 +237,8 @@ class BaseMeta(sqlalchemy.ext.declarative.DeclarativeMeta):
     when models are created."""
 
     def __new__(mcs, name, bases, attrs):
+        # every model gets its own relationships collection before declarative attributes are resolved
+        attrs.setdefault("_relationships", [])
         klass = super().__new__(mcs, name, bases, attrs)
         mcs.db.models_registry.append(klass)
         return klass
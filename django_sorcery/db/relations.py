@@ -1,39 +1,36 @@
 """sqlalchemy relationship related things."""
-from itertools import chain
+from functools import partial
+from weakref import WeakKeyDictionary
 
-import sqlalchemy as sa
+from sqlalchemy import Column, ForeignKeyConstraint, Table
+from sqlalchemy.exc import ArgumentError
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm.interfaces import MANYTOMANY, MANYTOONE, ONETOMANY
 
-from ..utils import setdefaultattr, suppress
 from .signals import declare_first
 
 
+_pk_attr_keys = WeakKeyDictionary()
+
+
 class RelationsMixin:
     """Mixin that provides django like shortcuts for relationships."""
 
     def _one_relation(self, remote_cls, direction, backref_uselist, kwargs):
-        @declared_attr
-        def o2m(cls):
-            rels = setdefaultattr(cls, "_relationships", set())
-            kwargs.setdefault("info", {}).update(self._get_kwargs_for_relation(kwargs))
-            backref = kwargs.get("backref")
-            if backref:
-                backref_kwargs = None
-                if isinstance(backref, tuple):
-                    with suppress(Exception):
-                        backref, backref_kwargs = backref
-
-                backref_kwargs = backref_kwargs or {}
-                backref_kwargs["uselist"] = backref_uselist
+        (fk_kwargs,) = _split_kwargs_by_prefixes(kwargs, prefixes=("fk_",))
+        kwargs["info"] = dict(kwargs.get("info") or {}, **fk_kwargs)
 
-                kwargs["backref"] = self.backref(backref, **backref_kwargs)
+        backref = kwargs.pop("backref", None)
+        backref_kwargs = None
+        if backref:
+            if isinstance(backref, tuple) and len(backref) == 2:
+                backref, backref_kwargs = backref
 
-            rel = self.relationship(remote_cls, **kwargs)
-            rel.direction = direction
-            rels.add(rel)
-            return rel
+            backref_kwargs = dict(backref_kwargs or {}, uselist=backref_uselist)
 
-        return o2m
+        return _declared_relationship(
+            self, remote_cls, direction=direction, backref=backref, backref_kwargs=backref_kwargs, kwargs=kwargs
+        )
 
     def OneToOne(self, remote_cls, **kwargs):
         """Use an event to build one-to-many relationship on a model and auto
@@ -50,9 +47,7 @@ class RelationsMixin:
         will create ModelTwo.m1_pk automatically for the relationship
         """
         kwargs["uselist"] = False
-        return self._one_relation(
-            remote_cls, direction=sa.orm.interfaces.MANYTOONE, backref_uselist=False, kwargs=kwargs
-        )
+        return self._one_relation(remote_cls, direction=MANYTOONE, backref_uselist=False, kwargs=kwargs)
 
     def OneToMany(self, remote_cls, **kwargs):
         """Use an event to build one-to-many relationship on a model and auto
@@ -69,9 +64,7 @@ class RelationsMixin:
         will create ModelTwo.m1_pk automatically for the relationship
         """
         kwargs["uselist"] = True
-        return self._one_relation(
-            remote_cls, direction=sa.orm.interfaces.ONETOMANY, backref_uselist=False, kwargs=kwargs
-        )
+        return self._one_relation(remote_cls, direction=ONETOMANY, backref_uselist=False, kwargs=kwargs)
 
     def ManyToOne(self, remote_cls, **kwargs):
         """Use an event to build many-to-one relationship on a model and auto
@@ -88,9 +81,7 @@ class RelationsMixin:
         will create ModelOne.m2_pk automatically for the relationship
         """
         kwargs["uselist"] = False
-        return self._one_relation(
-            remote_cls, direction=sa.orm.interfaces.MANYTOONE, backref_uselist=True, kwargs=kwargs
-        )
+        return self._one_relation(remote_cls, direction=MANYTOONE, backref_uselist=True, kwargs=kwargs)
 
     def ManyToMany(self, remote_cls, table_name=None, **kwargs):
         """Use an event to build many-to-many relationship on a model and auto
@@ -123,49 +114,89 @@ class RelationsMixin:
         declarations
         """
 
-        @declared_attr
-        def m2m(cls):
-            """many to many relationship attribute for declarative."""
-            if "secondary" not in kwargs and table_name is None:
-                raise sa.exc.ArgumentError(
-                    "You need to provide secondary or table_name for the relation for the association table "
-                    "that will be generated"
-                )
+        if "secondary" not in kwargs and table_name is None:
+            raise ArgumentError(
+                "You need to provide secondary or table_name for the relation for the association table "
+                "that will be generated"
+            )
+
+        fk_kwargs, table_kwargs = _split_kwargs_by_prefixes(kwargs)
+        info = dict(kwargs.get("info") or {}, **fk_kwargs, **table_kwargs)
+        if table_name:
+            info["table_name"] = table_name
+
+        kwargs["info"] = info
+        kwargs["uselist"] = True
+
+        backref = kwargs.pop("backref", None)
+        backref_kwargs = None
+        if backref:
+            if isinstance(backref, tuple) and len(backref) == 2:
+                backref, backref_kwargs = backref
 
-            rels = setdefaultattr(cls, "_relationships", set())
-            info = kwargs.setdefault("info", {})
-            info.update(self._get_kwargs_for_relation(kwargs))
-            info.update(self._get_kwargs_for_relation(kwargs, "table_"))
-            if table_name:
-                info["table_name"] = table_name
+            backref_kwargs = dict(backref_kwargs or {}, uselist=True)
 
-            kwargs["uselist"] = True
+        return _declared_relationship(
+            self, remote_cls, direction=MANYTOMANY, backref=backref, backref_kwargs=backref_kwargs, kwargs=kwargs
+        )
+
+    def _get_kwargs_for_relation(self, kwargs, prefix="fk_"):
+        (opts,) = _split_kwargs_by_prefixes(kwargs, prefixes=(prefix,))
+        return opts
 
-            backref = kwargs.get("backref")
-            backref_kwargs = None
-            if backref:
-                if isinstance(backref, tuple):
-                    with suppress(Exception):
-                        backref, backref_kwargs = backref
 
-                backref_kwargs = backref_kwargs or {}
+def _build_relationship(db, remote_cls, direction, backref, backref_kwargs, kwargs, cls):
+    """Build the relationship for a declarative class and queue it for foreign
+    key or association table generation."""
+    # sqlalchemy consumes backref kwargs so every relationship needs a fresh backref
+    if backref:
+        kwargs = dict(kwargs, backref=db.backref(backref, **backref_kwargs))
 
-                backref_kwargs["uselist"] = True
-                kwargs["backref"] = self.backref(backref, **backref_kwargs)
+    rel = db.relationship(remote_cls, **kwargs)
+    rel.direction = direction
+    cls._relationships.append(rel)
+    return rel
 
-            rel = self.relationship(remote_cls, **kwargs)
-            rel.direction = sa.orm.interfaces.MANYTOMANY
-            rels.add(rel)
-            return rel
 
-        return m2m
+def _declared_relationship(db, remote_cls, direction, backref, backref_kwargs, kwargs):
+    """Bind relationship arguments to _build_relationship as a declared_attr."""
+    fget = partial(_build_relationship, db, remote_cls, direction, backref, backref_kwargs, kwargs)
+    # declared_attr reports the getter by name when accessed on unmapped classes
+    fget.__name__ = _build_relationship.__name__
+    return declared_attr(fget)
 
-    def _get_kwargs_for_relation(self, kwargs, prefix="fk_"):
-        opts = {}
-        for key in list(kwargs.keys()):
+
+def _group_by_prefixes(mapping, prefixes, strip=False):
+    """Group items of mapping by the first prefix their key starts with,
+    optionally stripping that prefix from the key."""
+    buckets = tuple({} for _ in prefixes)
+    for key, val in mapping.items():
+        for prefix, bucket in zip(prefixes, buckets):
             if key.startswith(prefix):
-                opts[key] = kwargs.pop(key)
-        return opts
+                bucket[key[len(prefix) :] if strip else key] = val
+                break
+    return buckets
+
+
+def _split_kwargs_by_prefixes(kwargs, prefixes=("fk_", "table_")):
+    """Pop prefixed keys from kwargs in a single pass and return a dict of
+    them per prefix, in the same order as prefixes."""
+    buckets = _group_by_prefixes(kwargs, prefixes)
+    for bucket in buckets:
+        for key in bucket:
+            del kwargs[key]
+    return buckets
+
+
+def _get_pk_attr_keys(mapper):
+    """Return attribute keys of the mapper's local table primary key columns,
+    in primary key order, cached per mapper."""
+    keys = _pk_attr_keys.get(mapper)
+    if keys is None:
+        keys = _pk_attr_keys[mapper] = tuple(
+            mapper.get_property_by_column(pk_column).key for pk_column in mapper.local_table.primary_key
+        )
+    return keys
 
 
 def _add_foreign_keys(cls, parent_cls, relation):
@@ -177,7 +208,7 @@ def _add_foreign_keys(cls, parent_cls, relation):
     fk_key = fk_kwargs.pop("key", None)
 
     if not fk_key:
-        if relation.direction == sa.orm.interfaces.MANYTOONE:
+        if relation.direction == MANYTOONE:
             fk_key = relation.key.lower()
         elif relation.backref:
             backref, _ = relation.backref
@@ -185,32 +216,35 @@ def _add_foreign_keys(cls, parent_cls, relation):
         else:
             fk_key = parent_cls.__name__.lower()
 
-    cols = {}
+    columns = cls.__table__.columns
+    parent_mapper = parent_cls.__mapper__
+    primary_key = tuple(parent_mapper.local_table.primary_key)
+
+    col_prefix = fk_key + "_" if fk_key else ""
+    attr_prefix = fk_prefix + col_prefix
+
+    pairs = []
     cols_created = False
-    for pk_column in parent_cls.__table__.primary_key:
-        pk_attr = parent_cls.__mapper__.get_property_by_column(pk_column)
-        col_name = "_".join(filter(None, [fk_key, pk_column.name]))
-        attr = "{}{}".format(fk_prefix, "_".join(filter(None, [fk_key, pk_attr.key])))
+    for pk_column, pk_attr_key in zip(primary_key, _get_pk_attr_keys(parent_mapper)):
+        col_name = col_prefix + pk_column.name
+        attr = attr_prefix + pk_attr_key
 
-        if col_name not in cls.__table__.columns and not hasattr(cls, attr):
-            fk_column = sa.Column(col_name, pk_column.type, nullable=fk_nullable)
+        if col_name not in columns and not hasattr(cls, attr):
+            fk_column = Column(col_name, pk_column.type, nullable=fk_nullable)
             setattr(cls, attr, fk_column)
             cols_created = True
         else:
-            fk_column = cls.__table__.columns[col_name]
+            fk_column = columns[col_name]
 
-        cols[pk_column] = fk_column
+        pairs.append((pk_column, fk_column))
 
-    relation._user_defined_foreign_keys = cols.values()
+    relation._user_defined_foreign_keys = [fk_column for _, fk_column in pairs]
 
     if cols_created:
         # pk and fk ordering must match for foreign key constraint
-        pks, fks = [], []
-        for pk in cols:
-            pks.append(pk)
-            fks.append(cols[pk])
+        pks, fks = zip(*pairs)
 
-        constraint = sa.ForeignKeyConstraint(fks, pks, **fk_kwargs)
+        constraint = ForeignKeyConstraint(fks, pks, **fk_kwargs)
         cls.__table__.append_constraint(constraint)
 
 
@@ -221,26 +255,34 @@ def _add_association_table(cls, child_cls, relation):
         return
 
     table_name = relation.info.get("table_name")
-    relation.secondary = cls.metadata.tables.get(table_name)
+    schema = cls.__table__.schema
+    # metadata keys tables by schema qualified name
+    table_key = table_name if schema is None else "{}.{}".format(schema, table_name)
+    relation.secondary = cls.metadata.tables.get(table_key)
     if relation.secondary is not None:
         return
 
-    fk_kwargs = {key[3:]: val for key, val in relation.info.items() if key.startswith("fk_")}
-    table_kwargs = {key[6:]: val for key, val in relation.info.items() if key.startswith("table_")}
+    fk_kwargs, table_kwargs = _group_by_prefixes(relation.info, ("fk_", "table_"), strip=True)
     table_kwargs.pop("name", None)
 
-    column_map = {}
-    for pk_column in chain(cls.__mapper__.primary_key, child_cls.__table__.primary_key):
-        col_name = "_".join(filter(None, [pk_column.table.name.lower(), pk_column.name]))
-        col = sa.Column(col_name, pk_column.type, primary_key=True)
-        column_map.setdefault(pk_column.table, []).append(col)
+    # remember which of the collected columns point to each table
+    table_args = []
+    by_table = {}
+    for pk_column in cls.__mapper__.primary_key + tuple(child_cls.__table__.primary_key):
+        table = pk_column.table
+        entry = by_table.get(table)
+        if entry is None:
+            entry = by_table[table] = (table.name.lower() + "_", [])
 
-    table_args = list(chain(*column_map.values()))
+        col_prefix, indices = entry
+        indices.append(len(table_args))
+        table_args.append(Column(col_prefix + pk_column.name, pk_column.type, primary_key=True))
 
-    for table, columns in column_map.items():
-        table_args.append(sa.ForeignKeyConstraint(columns, table.primary_key, **fk_kwargs))
+    for table, (_, indices) in by_table.items():
+        columns = [table_args[i] for i in indices]
+        table_args.append(ForeignKeyConstraint(columns, table.primary_key, **fk_kwargs))
 
-    relation.secondary = sa.Table(table_name, cls.metadata, *table_args, schema=cls.__table__.schema, **table_kwargs)
+    relation.secondary = Table(table_name, cls.metadata, *table_args, schema=schema, **table_kwargs)
 
 
 @declare_first.connect
@@ -250,14 +292,17 @@ def declare_first_relationships_handler(cls):
     Can be called multiple times so once relationships are set, they are
     removed from model
     """
-    rels = getattr(cls, "_relationships", set())
+    rels = cls._relationships
 
+    buckets = {ONETOMANY: [], MANYTOONE: [], MANYTOMANY: []}
     for relation in rels:
-        if relation.direction == sa.orm.interfaces.ONETOMANY:
-            _add_foreign_keys(relation.mapper.class_, cls, relation)
-        elif relation.direction == sa.orm.interfaces.MANYTOONE:
-            _add_foreign_keys(cls, relation.mapper.class_, relation)
-        elif relation.direction == sa.orm.interfaces.MANYTOMANY:
-            _add_association_table(cls, relation.mapper.class_, relation)
+        buckets[relation.direction].append(relation)
+
+    for relation in buckets[ONETOMANY]:
+        _add_foreign_keys(relation.mapper.class_, cls, relation)
+    for relation in buckets[MANYTOONE]:
+        _add_foreign_keys(cls, relation.mapper.class_, relation)
+    for relation in buckets[MANYTOMANY]:
+        _add_association_table(cls, relation.mapper.class_, relation)
 
     rels.clear()
@@ -1,4 +1,5 @@
 import sqlalchemy as sa
+from django_sorcery.db import SQLAlchemy, relations
 
 from .. import models_backpop
 from ..base import TestCase
@@ -82,3 +83,75 @@ class TestSQLAlchemyRelationships(TestCase):
 
             class SuperDummy(models.db.Model):
                 bad = models.db.ManyToMany("blah")
+
+    def test_split_kwargs_by_prefixes(self):
+        kwargs = {"fk_name": "fk", "table_comment": "tbl", "backref": "b", "fk_nullable": False}
+
+        fk_kwargs, table_kwargs = relations._split_kwargs_by_prefixes(kwargs)
+
+        self.assertEqual(fk_kwargs, {"fk_name": "fk", "fk_nullable": False})
+        self.assertEqual(table_kwargs, {"table_comment": "tbl"})
+        self.assertEqual(kwargs, {"backref": "b"})
+
+    def test_relationships_are_per_model(self):
+        self.assertIn("_relationships", vars(models.Order))
+        self.assertIn("_relationships", vars(models.Asset))
+        self.assertIsNot(models.Order._relationships, models.Asset._relationships)
+
+    def test_get_kwargs_for_relation(self):
+        kwargs = {"fk_name": "fk", "table_comment": "tbl", "backref": "b"}
+
+        opts = models.db._get_kwargs_for_relation(kwargs, "table_")
+
+        self.assertEqual(opts, {"table_comment": "tbl"})
+        self.assertEqual(kwargs, {"fk_name": "fk", "backref": "b"})
+
+    def test_back_populates_shares_association_table(self):
+        order_contacts = models_backpop.Order.contacts.property
+        contact_orders = models_backpop.Contact.orders.property
+
+        self.assertIs(order_contacts.secondary, models_backpop.db.metadata.tables["order_contacts"])
+        self.assertIs(contact_orders.secondary, order_contacts.secondary)
+
+    def test_back_populates_association_table_with_schema(self):
+        db = SQLAlchemy("sqlite://")
+
+        class Order(db.Model):
+            pk = db.Column(db.Integer(), primary_key=True)
+            contacts = db.ManyToMany("Contact", back_populates="orders", table_name="order_contacts")
+
+            class Meta:
+                table_args = {"schema": "sales"}
+
+        class Contact(db.Model):
+            pk = db.Column(db.Integer(), primary_key=True)
+            orders = db.ManyToMany("Order", back_populates="contacts", table_name="order_contacts")
+
+            class Meta:
+                table_args = {"schema": "sales"}
+
+        db.configure_mappers()
+
+        self.assertIs(Order.contacts.property.secondary, db.metadata.tables["sales.order_contacts"])
+        self.assertIs(Contact.orders.property.secondary, Order.contacts.property.secondary)
+
+    def test_many_to_many_mixin_across_databases(self):
+        db1, db2 = SQLAlchemy("sqlite://"), SQLAlchemy("sqlite://")
+
+        class TagMixin:
+            tags = db1.ManyToMany("Tag", table_name="item_tags")
+
+        def make_models(db):
+            class Tag(db.Model):
+                pk = db.Column(db.Integer(), primary_key=True)
+
+            class Item(TagMixin, db.Model):
+                pk = db.Column(db.Integer(), primary_key=True)
+
+            return Item
+
+        item1, item2 = make_models(db1), make_models(db2)
+        db1.configure_mappers()
+
+        self.assertIs(item1.tags.property.secondary, db1.metadata.tables["item_tags"])
+        self.assertIs(item2.tags.property.secondary, db2.metadata.tables["item_tags"])